@@ -5,80 +5,114 @@ import torch.optim as optim
 import os
 import numpy as np
 import argparse
+import contextlib
+import copy
 import json
+import math
+import threading
 
 from torch.utils import data
+from torch.nn.parallel import DistributedDataParallel as DDP
 from .model import MultiTaskNet
 from .dataset import *
 from .train_util import *
 from tensorboardX import SummaryWriter
-from transformers import AdamW, get_linear_schedule_with_warmup
-from apex import amp
+from torch.optim import AdamW
+from transformers import get_linear_schedule_with_warmup
 
-def train(model, train_set, optimizer, scheduler=None, batch_size=32, fp16=False):
+def train(model, iterator, optimizer, scheduler=None, fp16=False,
+          scaler=None, amp_dtype=torch.float16, grad_accum_steps=1, debug=False,
+          verbose=True):
     """Perfrom one epoch of the training process.
 
     Args:
         model (MultiTaskNet): the current model state
-        train_set (SnippextDataset): the training dataset
+        iterator (DataLoader): the batch iterator of the training set
         optimizer: the optimizer for training (e.g., Adam)
-        batch_size (int, optional): the batch size
         fp16 (boolean): whether to use fp16
+        scaler (GradScaler, optional): the loss scaler for fp16 training
+        amp_dtype (torch.dtype, optional): the autocast dtype (float16 or bfloat16)
+        grad_accum_steps (int, optional): the number of batches to accumulate
+            gradients over before each optimizer step
+        debug (boolean, optional): whether to print a sanity check of the first batch
+        verbose (boolean, optional): whether to print the sanity check and the
+            loss (False on all but the first distributed process)
 
     Returns:
         None
     """
-    iterator = data.DataLoader(dataset=train_set,
-                               batch_size=batch_size,
-                               shuffle=True,
-                               num_workers=1,
-                               collate_fn=SnippextDataset.pad)
+    # the baseline trains a single task, so the criterion is fixed
+    taskname = iterator.dataset.taskname
+    if 'tagging' in taskname:
+        # <PAD> positions are skipped via ignore_index rather than by boolean
+        # masking, which would need a device sync and dynamic shapes each step
+        criterion = nn.CrossEntropyLoss(ignore_index=0)
+    elif 'sts-b' in taskname:
+        criterion = nn.MSELoss()
+    else:
+        criterion = nn.CrossEntropyLoss()
+
+    # the tokenizer is cached by get_tokenizer and shared with forked workers
+    tokenizer = get_tokenizer()
 
-    tagging_criterion = nn.CrossEntropyLoss(ignore_index=0)
-    classifier_criterion = nn.CrossEntropyLoss()
-    regression_criterion = nn.MSELoss()
+    # the model may be wrapped by DDP or torch.compile
+    device = next(model.parameters()).device
+    ddp_model = getattr(model, '_orig_mod', model)
 
     model.train()
+    optimizer.zero_grad(set_to_none=True)
+    # accumulated on device so that the loss is only synced when printed
+    running_loss = torch.zeros((), device=device)
     for i, batch in enumerate(iterator):
         # for monitoring
-        words, x, is_heads, tags, mask, y, seqlens, taskname = batch
-        taskname = taskname[0]
+        words, x, is_heads, tags, mask, y, seqlens, _ = batch
+        x = x.to(device, non_blocking=True)
+        y = y.to(device, non_blocking=True)
         _y = y
 
-        if 'tagging' in taskname:
-            criterion = tagging_criterion
-        elif 'sts-b' in taskname:
-            criterion = regression_criterion
+        # step every grad_accum_steps batches (and at the end of the epoch);
+        # under DDP, gradients are only all-reduced on the stepping batches
+        step = (i + 1) % grad_accum_steps == 0 or i + 1 == len(iterator)
+        if isinstance(ddp_model, DDP) and not step:
+            sync_context = ddp_model.no_sync()
         else:
-            criterion = classifier_criterion
+            sync_context = contextlib.nullcontext()
 
-        # forward
-        optimizer.zero_grad()
-        logits, y, _ = model(x, y, task=taskname)
-        if 'sts-b' in taskname:
-            logits = logits.view(-1)
-        else:
-            logits = logits.view(-1, logits.shape[-1])
-        y = y.view(-1)
-        loss = criterion(logits, y)
-
-        # back propagation
-        if fp16:
-            with amp.scale_loss(loss, optimizer) as scaled_loss:
-                scaled_loss.backward()
-        else:
-            loss.backward()
-        optimizer.step()
-        if scheduler:
-            scheduler.step()
+        with sync_context:
+            # forward
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=fp16):
+                logits, y, _ = model(x, y, task=taskname)
+                if 'sts-b' in taskname:
+                    logits = logits.view(-1)
+                else:
+                    logits = logits.view(-1, logits.shape[-1])
+                y = y.view(-1)
+                loss = criterion(logits, y) / grad_accum_steps
 
-        if i == 0:
+            # back propagation
+            if scaler is not None:
+                scaler.scale(loss).backward()
+            else:
+                loss.backward()
+
+        if step:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            if scheduler:
+                scheduler.step()
+
+        if verbose and debug and i == 0:
             print("=====sanity check======")
             print("words:", words[0])
-            print("x:", x.cpu().numpy()[0][:seqlens[0]])
-            print("tokens:", get_tokenizer().convert_ids_to_tokens(x.cpu().numpy()[0])[:seqlens[0]])
+            x_sample = x[0, :seqlens[0]].tolist()
+            print("x:", x_sample)
+            print("tokens:", tokenizer.convert_ids_to_tokens(x_sample))
             print("is_heads:", is_heads[0])
-            y_sample = _y.cpu().numpy()[0]
+            y_sample = _y[0].tolist()
             if np.isscalar(y_sample):
                 print("y:", y_sample)
             else:
@@ -89,9 +123,46 @@ def train(model, train_set, optimizer, scheduler=None, batch_size=32, fp16=False
             print("task_name:", taskname)
             print("=======================")
 
-        if i%10 == 0: # monitoring
-            print(f"step: {i}, task: {taskname}, loss: {loss.item()}")
-            del loss
+        running_loss += loss.detach()
+        if verbose and (i + 1) % 10 == 0: # monitoring (mean loss of the last 10 steps)
+            loss = (running_loss * grad_accum_steps / 10).item()
+            print(f"step: {i}, task: {taskname}, loss: {loss}")
+            running_loss.zero_()
+
+def cpu_state_dict(model):
+    """Return a snapshot of the state_dict of a model on the CPU.
+
+    The tensors are always copied (also for a model already on the CPU),
+    so later optimizer steps do not change the snapshot.
+
+    Args:
+        model (MultiTaskNet): the model state
+
+    Returns:
+        dict: the parameter name to CPU tensor mapping
+    """
+    state_dict = {k: v.detach().to('cpu', non_blocking=True, copy=True) \
+                  for k, v in model.state_dict().items()}
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return state_dict
+
+def save_state_dict(state_dict, path):
+    """Save a (CPU) state_dict in a background thread.
+
+    Serializing the checkpoint in a thread does not hold up the next
+    training epoch.
+
+    Args:
+        state_dict (dict): the state_dict returned by cpu_state_dict
+        path (str): the path of the checkpoint
+
+    Returns:
+        Thread: the thread writing the checkpoint
+    """
+    thread = threading.Thread(target=torch.save, args=(state_dict, path))
+    thread.start()
+    return thread
 
 def initialize_and_train(task_config,
                          trainset,
@@ -112,76 +183,202 @@ def initialize_and_train(task_config,
     Returns:
         None
     """
-    # create iterators for validation and test
+    # allow TF32 tensor cores for fp32 matmuls/convolutions (Ampere+)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
+    # one process per GPU when launched with torchrun / torch.distributed
+    distributed = hp.local_rank >= 0
+    if distributed:
+        torch.distributed.init_process_group('nccl')
+        torch.cuda.set_device(hp.local_rank)
+        rank = torch.distributed.get_rank()
+        world_size = torch.distributed.get_world_size()
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    else:
+        rank, world_size, local_world_size = 0, 1, 1
+
+    # create iterators for training, validation and test; the training
+    # iterator is reused across epochs to keep its workers alive. The CPUs
+    # are shared by all processes on the node.
     padder = SnippextDataset.pad
-    valid_iter = data.DataLoader(dataset=validset,
-                                 batch_size=hp.batch_size * 4,
-                                 shuffle=False,
-                                 num_workers=0,
-                                 collate_fn=padder)
-    test_iter = data.DataLoader(dataset=testset,
-                                 batch_size=hp.batch_size * 4,
-                                 shuffle=False,
-                                 num_workers=0,
+    nw = max(1, min(((os.cpu_count() or 2) - 2) // local_world_size, 8))
+    train_sampler = LengthBucketSampler(trainset.lengths,
+                                        hp.batch_size,
+                                        num_replicas=world_size,
+                                        rank=rank)
+    train_iter = data.DataLoader(dataset=trainset,
+                                 batch_sampler=train_sampler,
+                                 num_workers=nw,
+                                 pin_memory=torch.cuda.is_available(),
+                                 persistent_workers=nw > 0,
+                                 prefetch_factor=4,
                                  collate_fn=padder)
+    # only the first process evaluates
+    valid_iter = test_iter = None
+    if rank == 0:
+        valid_iter = data.DataLoader(dataset=validset,
+                                     batch_size=hp.batch_size * 4,
+                                     shuffle=False,
+                                     num_workers=nw,
+                                     pin_memory=torch.cuda.is_available(),
+                                     persistent_workers=nw > 0,
+                                     prefetch_factor=4,
+                                     collate_fn=padder)
+        test_iter = data.DataLoader(dataset=testset,
+                                    batch_size=hp.batch_size * 4,
+                                    shuffle=False,
+                                    num_workers=nw,
+                                    pin_memory=torch.cuda.is_available(),
+                                    persistent_workers=nw > 0,
+                                    prefetch_factor=4,
+                                    collate_fn=padder)
 
     # initialize model
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if distributed:
+        device = 'cuda:%d' % hp.local_rank
+    else:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
     model = MultiTaskNet([task_config],
                      device,
                      hp.finetuning,
                      lm=hp.lm,
                      bert_path=hp.bert_path)
+    # recompute the encoder activations in backward to allow larger batches
+    if hp.grad_ckpt:
+        model.bert.gradient_checkpointing_enable()
+
+    # eps and weight_decay match the transformers.AdamW defaults
     if device == 'cpu':
-        optimizer = AdamW(model.parameters(), lr=hp.lr)
+        optimizer = AdamW(model.parameters(), lr=hp.lr, eps=1e-6,
+                          weight_decay=0.0, foreach=True)
+        try:
+            import intel_extension_for_pytorch as ipex
+            model, optimizer = ipex.optimize(model, optimizer=optimizer,
+                    dtype=torch.bfloat16 if hp.fp16 else torch.float32)
+        except ImportError:
+            pass
     else:
         model = model.cuda()
-        optimizer = AdamW(model.parameters(), lr=hp.lr)
-        if hp.fp16:
-            model, optimizer = amp.initialize(model, optimizer, opt_level='O2')
+        optimizer = AdamW(model.parameters(), lr=hp.lr, eps=1e-6,
+                          weight_decay=0.0, fused=True)
+
+    # use bf16 autocast when supported (always on CPU); only fp16 needs loss scaling
+    if device == 'cpu' or torch.cuda.is_bf16_supported():
+        amp_dtype = torch.bfloat16
+    else:
+        amp_dtype = torch.float16
+    scaler = None
+    if hp.fp16 and device != 'cpu' and amp_dtype == torch.float16:
+        scaler = torch.cuda.amp.GradScaler()
+
+    # compile the training and eval forwards; dynamic since batches are
+    # padded to different lengths. Both share the parameters of the eager
+    # model, which is kept for saving.
+    train_model = eval_model = model
+    if distributed:
+        train_model = DDP(model,
+                          device_ids=[hp.local_rank],
+                          gradient_as_bucket_view=True,
+                          static_graph=True)
+    if hp.compile:
+        train_model = torch.compile(train_model, mode='reduce-overhead', dynamic=True)
+        eval_model = torch.compile(model, mode='max-autotune', dynamic=True)
 
     # learning rate scheduler
-    num_steps = (len(trainset) // hp.batch_size) * hp.n_epochs
+    # train() also steps on the leftover batches at the end of each epoch
+    num_steps = math.ceil(len(train_iter) / hp.grad_accum_steps) * hp.n_epochs
     scheduler = get_linear_schedule_with_warmup(optimizer,
                                                 num_warmup_steps=num_steps // 10,
                                                 num_training_steps=num_steps)
 
-    # create logging directory
-    if not os.path.exists(hp.logdir):
-        os.makedirs(hp.logdir)
-    writer = SummaryWriter(log_dir=hp.logdir)
+    # create logging directory (logging and saving only on the first process)
+    writer = None
+    if rank == 0:
+        if not os.path.exists(hp.logdir):
+            os.makedirs(hp.logdir)
+        writer = SummaryWriter(log_dir=hp.logdir)
 
     # start training
     best_dev_f1 = best_test_f1 = 0.0
+    save_threads = []
+    pending = {} # checkpoint path -> best state_dict not yet written
     epoch = 1
     while epoch <= hp.n_epochs:
-        train(model,
-              trainset,
+        train_sampler.set_epoch(epoch)
+        train(train_model,
+              train_iter,
               optimizer,
               scheduler=scheduler,
-              batch_size=hp.batch_size,
-              fp16=hp.fp16)
-
-        print(f"=========eval at epoch={epoch}=========")
-        dev_f1, test_f1 = eval_on_task(epoch,
-                            model,
-                            task_config['name'],
-                            valid_iter,
-                            validset,
-                            test_iter,
-                            testset,
-                            writer,
-                            run_tag)
+              fp16=hp.fp16,
+              scaler=scaler,
+              amp_dtype=amp_dtype,
+              grad_accum_steps=hp.grad_accum_steps,
+              debug=hp.debug,
+              verbose=rank == 0)
+
+        # evaluate on the first process and share the scores with the others
+        scores = [0.0, 0.0]
+        if rank == 0:
+            print(f"=========eval at epoch={epoch}=========")
+            scores = list(eval_on_task(epoch,
+                                eval_model,
+                                task_config['name'],
+                                valid_iter,
+                                validset,
+                                test_iter,
+                                testset,
+                                writer,
+                                run_tag))
+        if distributed:
+            torch.distributed.broadcast_object_list(scores, src=0)
+        dev_f1, test_f1 = scores
 
         if dev_f1 > 1e-6:
-            epoch += 1
-            if hp.save_model:
+            if hp.save_model and rank == 0:
+                state_dict = None
                 if dev_f1 > best_dev_f1:
                     best_dev_f1 = dev_f1
-                    torch.save(model.state_dict(), run_tag + '_dev.pt')
+                    state_dict = cpu_state_dict(model)
+                    pending[run_tag + '_dev.pt'] = state_dict
                 if test_f1 > best_test_f1:
                     best_test_f1 = test_f1
-                    torch.save(model.state_dict(), run_tag + '_test.pt')
+                    if state_dict is None:
+                        state_dict = cpu_state_dict(model)
+                    pending[run_tag + '_test.pt'] = state_dict
+
+                # write the best models every save_every epochs and at the end
+                if pending and (epoch % hp.save_every == 0 or epoch == hp.n_epochs):
+                    # wait for the previous checkpoints before overwriting them
+                    for thread in save_threads:
+                        thread.join()
+                    save_threads = [save_state_dict(state_dict, path) \
+                                    for path, state_dict in pending.items()]
+                    pending = {}
+            epoch += 1
+
+    # score a dynamically quantized INT8 copy of the final model on CPU
+    if hp.int8_eval and rank == 0:
+        q_model = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).cpu(),
+                                                          {nn.Linear},
+                                                          dtype=torch.qint8)
+        q_model.device = 'cpu'
+        print("=========eval of the int8 model=========")
+        eval_on_task(hp.n_epochs,
+                     q_model,
+                     task_config['name'],
+                     valid_iter,
+                     validset,
+                     test_iter,
+                     testset,
+                     writer,
+                     run_tag + '_int8')
 
-    writer.close()
+    for thread in save_threads:
+        thread.join()
+    if writer is not None:
+        writer.close()
+    if distributed:
+        torch.distributed.destroy_process_group()
 
@@ -93,6 +93,10 @@ class SnippextDataset(data.Dataset):
         self.sents, self.tags_li = sents, tags_li
         self.vocab = vocab
 
+        # sequence lengths (in words) for length-bucketed batching
+        self.lengths = [len(sent) if isinstance(sent, list) else len(sent.split()) \
+                        for sent in sents]
+
         # add special tags for tagging
         if '_tagging' in taskname:
             if 'O' not in self.vocab:
@@ -314,22 +318,27 @@ class SnippextDataset(data.Dataset):
             batch:
 
         Returns (TODO):
-            return words, f(x), is_heads, tags, f(mask), f(y), seqlens, name
+            return words, x (int32), is_heads, tags, mask, y, seqlens, name
         '''
         f = lambda x: [sample[x] for sample in batch]
-        g = lambda x, seqlen, val: \
-              [sample[x] + [val] * (seqlen - len(sample[x])) \
-               for sample in batch] # 0: <pad>
+
+        def g(x, seqlen, val, dtype=np.int64):
+            # fill one preallocated (batch, seqlen) array; val: <pad>
+            padded = np.full((len(batch), seqlen), val, dtype=dtype)
+            for row, sample in zip(padded, batch):
+                row[:len(sample[x])] = sample[x]
+            return torch.from_numpy(padded)
 
         # get maximal sequence length
         seqlens = f(6)
-        maxlen = np.array(seqlens).max()
+        maxlen = max(seqlens)
 
         # get task name
         name = f(7)
 
         words = f(0)
-        x = g(1, maxlen, 0)
+        # int32 token ids are enough for the vocab and halve the index traffic
+        x = g(1, maxlen, 0, dtype=np.int32)
         is_heads = f(2)
         tags = f(3)
         mask = g(4, maxlen, 1)
@@ -337,10 +346,67 @@ class SnippextDataset(data.Dataset):
             y = g(5, maxlen, 0)
         else:
             y = f(5)
+            if isinstance(y[0], float):
+                y = torch.Tensor(y)
+            else:
+                y = torch.LongTensor(y)
+        return words, x, is_heads, tags, mask, y, seqlens, name
+
+
+class LengthBucketSampler(data.Sampler):
+    def __init__(self, lengths, batch_size, bucket_size=100,
+                 num_replicas=1, rank=0, seed=0):
+        """Batch sampler grouping examples of similar lengths together.
 
-        f = torch.LongTensor
-        if isinstance(y[0], float):
-            y = torch.Tensor(y)
+        The indices are shuffled and cut into buckets of bucket_size batches.
+        Each bucket is sorted by length and split into batches, then the
+        batches are shuffled so that the order of lengths stays random.
+        For distributed training, every process shuffles with the same seed
+        (see set_epoch) and takes its own share of the batches.
+
+        Args:
+            lengths (list of int): the length of each example
+            batch_size (int): the batch size (per process)
+            bucket_size (int, optional): the number of batches in a bucket
+            num_replicas (int, optional): the number of processes
+            rank (int, optional): the rank of the current process
+            seed (int, optional): the shuffling seed for distributed training
+        """
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Set the epoch number, which seeds the distributed shuffling"""
+        self.epoch = epoch
+
+    def __iter__(self):
+        """Yield the batches (lists of indices) of one epoch"""
+        if self.num_replicas > 1:
+            rng = random.Random(self.seed + self.epoch)
         else:
-            y = torch.LongTensor(y)
-        return words, f(x), is_heads, tags, f(mask), y, seqlens, name
+            rng = random
+        indices = list(range(len(self.lengths)))
+        rng.shuffle(indices)
+
+        batches = []
+        chunk = self.batch_size * self.bucket_size
+        for start in range(0, len(indices), chunk):
+            bucket = sorted(indices[start:start + chunk],
+                            key=lambda idx: self.lengths[idx])
+            for pos in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[pos:pos + self.batch_size])
+
+        rng.shuffle(batches)
+        # every process gets the same number of batches
+        end = len(self) * self.num_replicas
+        return iter(batches[self.rank:end:self.num_replicas])
+
+    def __len__(self):
+        """Return the number of batches (of the current process)"""
+        num_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        return num_batches // self.num_replicas
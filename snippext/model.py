@@ -108,15 +108,15 @@ class MultiTaskNet(nn.Module):
             Tensor: yhat
             Tensor (optional): enc"""
 
-        # move input to GPU
-        x = x.to(self.device)
-        y = y.to(self.device)
+        # move input to GPU (async when the batch is in pinned memory)
+        x = x.to(self.device, non_blocking=True)
+        y = y.to(self.device, non_blocking=True)
         if second_batch != None:
             index, lam = second_batch
             lam = torch.tensor(lam).to(self.device)
         if augment_batch != None:
             aug_x, aug_lam = augment_batch
-            aug_x = aug_x.to(self.device)
+            aug_x = aug_x.to(self.device, non_blocking=True)
             aug_lam = torch.tensor(aug_lam).to(self.device)
 
         dropout = self.module_dict[task + '_dropout']
@@ -12,16 +12,28 @@ if __name__=="__main__":
     parser.add_argument("--lm", type=str, default="bert")
     parser.add_argument("--run_id", type=int, default=0)
     parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--grad_accum_steps", type=int, default=1)
     parser.add_argument("--lr", type=float, default=0.0001)
     parser.add_argument("--n_epochs", type=int, default=30)
     parser.add_argument("--max_len", type=int, default=64)
     parser.add_argument("--finetuning", dest="finetuning", action="store_true")
     parser.add_argument("--fp16", dest="fp16", action="store_true")
+    parser.add_argument("--compile", dest="compile", action="store_true")
+    parser.add_argument("--grad_ckpt", dest="grad_ckpt", action="store_true")
+    parser.add_argument("--int8_eval", dest="int8_eval", action="store_true")
     parser.add_argument("--save_model", dest="save_model", action="store_true")
+    parser.add_argument("--save_every", type=int, default=1)
+    parser.add_argument("--debug", dest="debug", action="store_true")
     parser.add_argument("--logdir", type=str, default="checkpoints/")
     parser.add_argument("--bert_path", type=str, default=None)
+    parser.add_argument("--local_rank", "--local-rank", type=int,
+                        default=int(os.environ.get("LOCAL_RANK", -1)))
 
     hp = parser.parse_args()
+    if hp.grad_accum_steps < 1:
+        parser.error("--grad_accum_steps must be at least 1")
+    if hp.save_every < 1:
+        parser.error("--save_every must be at least 1")
 
     # only a single task for baseline
     task = hp.task